@@ -4,8 +4,8 @@ Record GNSS data from a particular band/code
 using HackRF SDR, and output in SigMF format
 """
 from subprocess import Popen, PIPE, STDOUT
-import re
 import argparse
+import shlex
 import os
 import json
 from datetime import datetime, timezone
@@ -110,6 +110,26 @@ def band_gains(bandcode):
         case _:
             return 40, 40
 
+def next_file_number(path_stem):
+    """
+    Find the next unused output file number, for files named like `{path_stem}_0001.sigmf-data`,
+    with a single scan of the current directory (rather than probing each candidate name)
+
+    :param path_stem: the common prefix of the output file names
+    :return: one more than the highest file number already in use, or 1 if there are none
+    """
+    prefix = f'{path_stem}_'
+    suffix = '.sigmf-data'
+    max_file_number = 0
+    with os.scandir('.') as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith(prefix) and name.endswith(suffix):
+                number_str = name[len(prefix):-len(suffix)]
+                if number_str.isascii() and number_str.isdigit():
+                    max_file_number = max(max_file_number, int(number_str))
+    return max_file_number + 1
+
 def main():
     parser = argparse.ArgumentParser(description='Grab some GNSS data using hackrf_transfer')
     parser.add_argument('--band', '-b', dest='bandcode', default='L1',
@@ -155,48 +175,49 @@ def main():
     freq_lower_edge = int(ctr_freq_hz - half_baseband_bandwidth)
     freq_upper_edge = int(ctr_freq_hz + half_baseband_bandwidth)
     # figure out where to put the output files automatically
-    file_number = 1
     path_stem = f'hrf_gnss_{bandcode}_{duration_seconds}s'
+    file_number = next_file_number(path_stem)
     data_out_path = f'{path_stem}_{file_number:04d}.sigmf-data'
-    while os.path.isfile(data_out_path):
-        file_number += 1
-        data_out_path = f'{path_stem}_{file_number:04d}.sigmf-data'
     meta_out_path = f'{path_stem}_{file_number:04d}.sigmf-meta'
 
     # sample SN: 0000000000000000c66c63dc2d898983
-    opt_str = f"-f {ctr_freq_hz} -a 1 -l {if_lna_gain_db} -g {baseband_gain_db} -b {baseband_filter_bw_hz} -s {sample_rate_hz} -n {n_samples}  -B -r {data_out_path}"
+    opt_argv = ['-f', str(ctr_freq_hz), '-a', '1', '-l', str(if_lna_gain_db), '-g', str(baseband_gain_db),
+                '-b', str(baseband_filter_bw_hz), '-s', str(sample_rate_hz), '-n', str(n_samples),
+                '-B', '-r', data_out_path]
     if specific_hrf_sn is None:
-        cmd_str = f"hackrf_transfer {opt_str}"
+        cmd_argv = ['hackrf_transfer'] + opt_argv
     else:
-        cmd_str = f"hackrf_transfer -d {specific_hrf_sn} {opt_str}"
+        cmd_argv = ['hackrf_transfer', '-d', specific_hrf_sn] + opt_argv
+    cmd_str = shlex.join(cmd_argv)
 
     print(f"START:\n{cmd_str} ")
 
-    # Regex to match and extract numeric values
-    regex = r"[-+]?\d*\.\d+|\d+"
-
     total_power = float(0)
     step_count = 0
     line_count = 0
     capture_start_utc = None
     if bandcode != 'V1':
-        with (Popen([cmd_str], stdout=PIPE, stderr=STDOUT, text=True, shell=True) as proc):
-            for line in proc.stdout:
+        capture_start_utc = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        with (Popen(cmd_argv, stdout=PIPE, stderr=STDOUT, bufsize=65536) as proc):
+            for raw_line in proc.stdout:
                 if line_count > 6: # skip command startup lines
-                    if capture_start_utc is None:
-                        capture_start_utc = datetime.utcnow().isoformat()+'Z'
-
-                    numeric_values = re.findall(regex, line)
-                    if numeric_values is not None and len(numeric_values) == 7:
-                        # 8.1 MiB / 1.000 sec =  8.1 MiB/second, average power -2.0 dBfs, 14272 bytes free in buffer, 0 overruns, longest 0 bytes
-                        # ['8.1', '1.000', '8.1', '-2.0', '14272', '0', '0']
-                        print(numeric_values)
-                        step_power = numeric_values[3]
-                        total_power += float(step_power)
-                        step_count += 1
-                    else:
+                    # 8.1 MiB / 1.000 sec =  8.1 MiB/second, average power -2.0 dBfs, 14272 bytes free in buffer, 0 overruns, longest 0 bytes
+                    if b'average power' not in raw_line:
                         # read all the stdout until finished, else data out files are not flushed
                         continue
+                    # only the power status lines are worth decoding
+                    line = raw_line.decode('ascii', 'ignore')
+                    _, sep, tail = line.partition('average power ')
+                    if not sep:
+                        continue
+                    power_str, _, _ = tail.partition(' ')
+                    try:
+                        step_power = float(power_str.rstrip(','))
+                    except ValueError:
+                        continue
+                    print(line.rstrip())
+                    total_power += step_power
+                    step_count += 1
                 line_count += 1
     else:
         # save a fake signal file
@@ -218,10 +239,10 @@ def main():
     meta_info_dict = {
     "global": {
         SigMFFile.DATATYPE_KEY: 'ci8',
-        SigMFFile.SAMPLE_RATE_KEY: int(f'{sample_rate_hz}'),
+        SigMFFile.SAMPLE_RATE_KEY: sample_rate_hz,
         SigMFFile.HW_KEY: "HackRF, HT004a boost amp, bias tee, active ceramic patch antenna",
         SigMFFile.AUTHOR_KEY: 'Todd Stellanova',
-        SigMFFile.VERSION_KEY: f'{sigmf.__version__}', 
+        SigMFFile.VERSION_KEY: sigmf.__version__,
         SigMFFile.DESCRIPTION_KEY: f'GNSS {bandcode} recorded using hackrf_transfer',
         SigMFFile.RECORDER_KEY: 'hackrf_transfer',
         'antenna:type': 'patch',
@@ -235,31 +256,28 @@ def main():
     "captures": [
         {
             SigMFFile.START_INDEX_KEY: 0,
-            SigMFFile.FREQUENCY_KEY: int(f'{ctr_freq_hz}'), 
+            SigMFFile.FREQUENCY_KEY: ctr_freq_hz,
             SigMFFile.DATETIME_KEY: f'{capture_start_utc}',
-            'stellanovat:if_gain_db': int(f'{if_lna_gain_db}'),
-            'stellanovat:bb_gain_db': int(f'{baseband_gain_db}'),
+            'stellanovat:if_gain_db': if_lna_gain_db,
+            'stellanovat:bb_gain_db': baseband_gain_db,
             'stellanovat:sdr_rx_amp_enabled': 0,
-            "stellanovat:recorder_command": f'{cmd_str}',
+            "stellanovat:recorder_command": cmd_str,
         }
     ],
     "annotations": [
         {
             SigMFFile.START_INDEX_KEY: 0,
-            SigMFFile.LENGTH_INDEX_KEY: int(f'{n_samples}'),
-            SigMFFile.FHI_KEY: int(f'{freq_upper_edge}'),
-            SigMFFile.FLO_KEY: int(f'{freq_lower_edge}'),
+            SigMFFile.LENGTH_INDEX_KEY: n_samples,
+            SigMFFile.FHI_KEY: freq_upper_edge,
+            SigMFFile.FLO_KEY: freq_lower_edge,
             SigMFFile.LABEL_KEY: f'GNSS {bandcode}',
             'stellanovat:avg_dbfs':float(f'{avg_power:0.3f}'),
         }
     ]
     }
 
-    meta_json = json.dumps(meta_info_dict, indent=2)
-    # print(meta_json)
-    
-    with open(meta_out_path, "w") as meta_outfile:
-        meta_outfile.write(meta_json)
+    with open(meta_out_path, "w", buffering=1 << 16) as meta_outfile:
+        json.dump(meta_info_dict, meta_outfile, indent=2)
 
     print(f"wrote {meta_out_path}")
 
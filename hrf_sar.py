@@ -3,77 +3,196 @@
 Continuously SAR data at full bandwidth
 using HackRF SDR, and output in SigMF format
 """
-from subprocess import Popen, PIPE, STDOUT
-import re
+from subprocess import Popen, PIPE
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, wait
 import argparse
+import io
+import shlex
 import os
+import errno
 import shutil
 import json
-from datetime import datetime, timezone
+import queue
+import time
 
 import numpy as np
 import sigmf
 from sigmf import SigMFFile
 
 
-def capture_one_data_segment(cmd_str_stem=None, data_out_path=None):
-    # assumes that HackrF software version supports `-B` power reporting flag
-    cmd_str = f"{cmd_str_stem} -r {data_out_path}"
+def utc_timestamp_strs(t):
+    """
+    Format a POSIX time as UTC timestamps, without building datetime objects
+
+    :param t: seconds since the epoch, eg from time.time()
+    :return: (ISO 8601 timestamp eg `2024-09-15T04:28:13.123456Z`, compact timestamp eg `20240915_042813Z`)
+    """
+    tm = time.gmtime(t)
+    iso_str = f"{time.strftime('%Y-%m-%dT%H:%M:%S', tm)}.{int((t % 1) * 1E6):06d}Z"
+    return iso_str, time.strftime('%Y%m%d_%H%M%SZ', tm)
+
+
+def read_power_reports(status_stream, power_reports):
+    """
+    Collect the `-B` power reports that hackrf_transfer prints (on stderr) once per second,
+    for as long as it keeps running. Closes the stream once hackrf_transfer exits.
+
+    :param status_stream: hackrf_transfer stderr, opened in binary mode
+    :param power_reports: queue that receives each reported average power (dBFS)
+    """
+    with status_stream:
+        for raw_line in status_stream:
+            # 8.1 MiB / 1.000 sec =  8.1 MiB/second, average power -2.0 dBfs, 14272 bytes free in buffer, 0 overruns, longest 0 bytes
+            if b'average power' not in raw_line:
+                continue
+            # only the power status lines are worth decoding
+            line = raw_line.decode('ascii', 'ignore')
+            _, sep, tail = line.partition('average power ')
+            if not sep:
+                continue
+            power_str, _, _ = tail.partition(' ')
+            try:
+                step_power = float(power_str.rstrip(','))
+            except ValueError:
+                continue
+            print(line.rstrip())
+            power_reports.put(step_power)
+
 
+def start_streaming_capture(cmd_argv, cmd_str):
+    """
+    Launch a single long-running hackrf_transfer that streams samples to its stdout
+
+    :param cmd_argv: hackrf_transfer argv list, built once by main
+    :param cmd_str: the same command as a display string, for logging
+    :return: (process, queue of power reports)
+    """
     print(f"START:\n{cmd_str} ")
+    # stdout stays unbuffered since samples are read straight into the segment buffer,
+    # but the status lines on stderr are read through a buffer rather than a byte at a time
+    proc = Popen(cmd_argv, stdout=PIPE, stderr=PIPE, bufsize=0)
+    status_stream = io.BufferedReader(proc.stderr, 1 << 16)
+    power_reports = queue.SimpleQueue()
+    Thread(target=read_power_reports, args=(status_stream, power_reports), daemon=True).start()
+    return proc, power_reports
+
 
-    # Regex to match and extract numeric values
-    regex = r"[-+]?\d*\.\d+|\d+"
+def capture_one_data_segment(sample_stream, power_reports, segment_buf, step_powers):
+    """
+    Read the next segment of samples from the running hackrf_transfer into memory,
+    and summarize the power levels reported while that segment was being received.
 
-    total_power = float(0)
+    :param sample_stream: hackrf_transfer stdout, unbuffered
+    :param power_reports: queue of power reports filled by read_power_reports
+    :param segment_buf: preallocated bytearray sized to hold one segment of interleaved I/Q samples
+    :param step_powers: preallocated float array that receives the power reports for this segment
+    :return: (bytes captured, max_power, avg_power)
+    """
     avg_power = float(0)
     max_power = float(-200)
     step_count = 0
-    line_count = 0
-    capture_start_utc = None
-
-    with (Popen([cmd_str], stdout=PIPE, stderr=STDOUT, text=True, shell=True) as proc):
-        for line in proc.stdout:
-            if line_count > 6:  # skip command startup lines
-                if capture_start_utc is None:
-                    capture_start_utc = datetime.utcnow().isoformat() + 'Z'
-
-                numeric_values = re.findall(regex, line)
-                if numeric_values is not None and len(numeric_values) == 7:
-                    # 8.1 MiB / 1.000 sec =  8.1 MiB/second, average power -2.0 dBfs, 14272 bytes free in buffer, 0 overruns, longest 0 bytes
-                    # ['8.1', '1.000', '8.1', '-2.0', '14272', '0', '0']
-                    print(numeric_values)
-                    step_power = float(numeric_values[3])
-                    if step_power > max_power:
-                        max_power = step_power
-                    total_power += step_power
-                    step_count += 1
-                else:
-                    # read all the stdout until finished, else data out files are not flushed
-                    continue
-            line_count += 1
-
-    rc = proc.returncode
-    if 0 != rc:
-        print(f"hackrf_transfer failed with result code: {rc}")
-    else:
-        avg_power = total_power / float(step_count)
+
+    segment_view = memoryview(segment_buf)
+    segment_nbytes = len(segment_buf)
+    n_captured = 0
+    while n_captured < segment_nbytes:
+        n_read = sample_stream.readinto(segment_view[n_captured:])
+        if not n_read:
+            # hackrf_transfer has exited
+            break
+        n_captured += n_read
+
+    # the power reports received so far cover (approximately) this segment:
+    # drain all of them, so that none spill over into the next segment's stats
+    n_dropped = 0
+    while True:
+        try:
+            step_power = power_reports.get_nowait()
+        except queue.Empty:
+            break
+        if step_count < len(step_powers):
+            step_powers[step_count] = step_power
+            step_count += 1
+        else:
+            n_dropped += 1
+    if n_dropped > 0:
+        print(f"ignored {n_dropped} extra power reports")
+
+    if step_count > 0:
+        max_power = float(step_powers[:step_count].max())
+        avg_power = float(step_powers[:step_count].mean())
         print(f"max_power: {max_power:0.3f} avg_power: {avg_power:0.3f} (dBFS)")
 
-    return max_power, avg_power
+    return n_captured, max_power, avg_power
+
+
+def save_segment(segment_buf, tmp_data_file_path, solid_data_file_path, meta_out_path, meta_json):
+    """
+    Persist a kept segment: write its samples to a temporary file,
+    move that into place, then write the matching meta file.
+    Runs on a writer thread so that the sample stream keeps draining meanwhile.
+    """
+    # buffered writes loop until the whole segment is written, even past the 2 GiB write(2) limit
+    with open(tmp_data_file_path, "wb") as data_outfile:
+        data_outfile.write(segment_buf)
+
+    # move the tmp data file to a more persistent location
+    print(f"moving {tmp_data_file_path} to {solid_data_file_path} ...")
+    try:
+        os.replace(tmp_data_file_path, solid_data_file_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # tmp_path is on a different filesystem: copy, then delete the tmp file
+        shutil.move(tmp_data_file_path, solid_data_file_path)
+    drop_cached_pages(solid_data_file_path)
+
+    with open(meta_out_path, "w", buffering=1 << 16) as meta_outfile:
+        meta_outfile.write(meta_json)
+    print(f"wrote:\n{meta_out_path}")
+
+
+def report_save_failure(save_future):
+    """
+    Log a failed save_segment as soon as it happens,
+    rather than leaving the error unseen in its future
+    """
+    exc = save_future.exception()
+    if exc is not None:
+        print(f"failed to save segment: {exc!r}")
+
+
+def drop_cached_pages(file_path):
+    """
+    Flush a recorded data file to storage, then hint the kernel that its cached pages won't be read again,
+    so that nonstop recording doesn't push everything else out of the page cache.
+    No-op on platforms (eg macOS) without posix_fadvise.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        # only clean pages can be dropped, so write back the dirty ones first
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
 
 
 def main():
     parser = argparse.ArgumentParser(description="""
         Grab some SAR data using hackrf_transfer""")
     parser.add_argument('--duration', '-d', type=int, default=15,
-                        help='Duration to capture, in seconds')
+                        help='Duration of each segment, in seconds. '
+                             'Two segments are held in RAM: about 80 MB per second of duration (1.2 GB at 15 s)')
     parser.add_argument('--serial_num', '-sn', default=None,
                         help='Specific HackRF serial number to use')
     parser.add_argument('--center_freq_mhz', '-fc', dest='fc_mhz', type=float, default=5405.5000,
                         help='Center frequency to record, in MHz')
     parser.add_argument("--tmp_path", dest='tmp_path', default=None,
-                        help="Directory path to place temporary files (e.g. a ramdisk)")
+                        help="Directory path to stage kept data files while they're written (e.g. a ramdisk). "
+                             "Defaults to out_path, which avoids copying each kept file")
     parser.add_argument("--out_path", dest='out_path', default='../../baseband/sar-recordings/',
                         help="Directory path to place output files")
     parser.add_argument('--squelch_dbfs', dest='squelch_dbfs', type=float, default=-29.0,
@@ -122,23 +241,36 @@ def main():
     base_filename_stem = f'hrf_sar_{int(freq_ctr_mhz)}_{duration_seconds}s'
 
     # assumes that HackrF software version supports `-B` power reporting flag
-    opt_str = f"-f {ctr_freq_hz} -a 1 -l {if_lna_gain_db} -g {baseband_gain_db} -b {baseband_filter_bw_hz} -s {sample_rate_hz} -n {n_samples}  -B "
+    # No `-n` sample count: hackrf_transfer streams nonstop to stdout, and we split that into segments
+    opt_argv = ['-f', str(ctr_freq_hz), '-a', '1', '-l', str(if_lna_gain_db), '-g', str(baseband_gain_db),
+                '-b', str(baseband_filter_bw_hz), '-s', str(sample_rate_hz), '-B', '-r', '-']
     if specific_hrf_sn is None:
-        cmd_str_stem = f"hackrf_transfer {opt_str}"
+        cmd_argv = ['hackrf_transfer'] + opt_argv
     else:
-        cmd_str_stem = f"hackrf_transfer -d {specific_hrf_sn} {opt_str}"
+        cmd_argv = ['hackrf_transfer', '-d', specific_hrf_sn] + opt_argv
+    cmd_str = shlex.join(cmd_argv)
+
+    # ci8: each sample is one signed byte of I followed by one of Q
+    segment_nbytes = n_samples * 2
+    # Segments are held in memory until we know whether to keep them, so that discarded segments
+    # never touch the disk. While one kept segment is being saved the next is captured into the other buffer.
+    segment_bufs = [bytearray(segment_nbytes), bytearray(segment_nbytes)]
+    segment_writer = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+    # hackrf_transfer reports power once per second: leave some headroom for jitter
+    step_powers = np.empty(duration_seconds + 4, dtype=np.float64)
 
-    basic_capture_start_utc = datetime.utcnow().isoformat() + 'Z'
+    basic_capture_start_utc, _ = utc_timestamp_strs(time.time())
 
     # TODO look at using the SigMFFile object, directly, instead
     meta_info_dict = {
         "global": {
             SigMFFile.DATATYPE_KEY: 'ci8',
-            SigMFFile.SAMPLE_RATE_KEY: int(f'{sample_rate_hz}'),
+            SigMFFile.SAMPLE_RATE_KEY: sample_rate_hz,
             SigMFFile.HW_KEY: "HackRF, LNA, antenna",
             SigMFFile.AUTHOR_KEY: 'Todd Stellanova',
-            SigMFFile.VERSION_KEY: f'{sigmf.__version__}',
-            SigMFFile.DESCRIPTION_KEY: f'SAR recorded using hackrf_transfer',
+            SigMFFile.VERSION_KEY: sigmf.__version__,
+            SigMFFile.DESCRIPTION_KEY: 'SAR recorded using hackrf_transfer',
             SigMFFile.RECORDER_KEY: 'hackrf_transfer',
             'antenna:type': 'Wideband',
             'stellanovat:sdr': 'HackRF',
@@ -149,36 +281,54 @@ def main():
         "captures": [
             {
                 SigMFFile.START_INDEX_KEY: 0,
-                SigMFFile.FREQUENCY_KEY: int(f'{ctr_freq_hz}'),
-                SigMFFile.DATETIME_KEY: f'{basic_capture_start_utc}',  # replace later
-                'stellanovat:if_gain_db': int(f'{if_lna_gain_db}'),
-                'stellanovat:bb_gain_db': int(f'{baseband_gain_db}'),
+                SigMFFile.FREQUENCY_KEY: ctr_freq_hz,
+                SigMFFile.DATETIME_KEY: basic_capture_start_utc,  # replace later
+                'stellanovat:if_gain_db': if_lna_gain_db,
+                'stellanovat:bb_gain_db': baseband_gain_db,
                 'stellanovat:sdr_rx_amp_enabled': 1,
-                "stellanovat:recorder_command": f'{cmd_str_stem}',
+                "stellanovat:recorder_command": cmd_str,
                 "stellanovat:max_power_dbfs": 0
             }
         ],
         "annotations": [
             {
                 SigMFFile.START_INDEX_KEY: 0,
-                SigMFFile.LENGTH_INDEX_KEY: int(f'{n_samples}'),
-                SigMFFile.FHI_KEY: int(f'{freq_upper_edge}'),
-                SigMFFile.FLO_KEY: int(f'{freq_lower_edge}'),
-                SigMFFile.LABEL_KEY: f'SAR',
+                SigMFFile.LENGTH_INDEX_KEY: n_samples,
+                SigMFFile.FHI_KEY: freq_upper_edge,
+                SigMFFile.FLO_KEY: freq_lower_edge,
+                SigMFFile.LABEL_KEY: 'SAR',
             }
         ]
     }
 
+    # Only the captures section changes between segments, so serialize the rest just once.
+    # Nested sections are re-indented to match the output of json.dump(meta_info_dict, indent=2)
+    global_json = json.dumps(meta_info_dict["global"], indent=2).replace('\n', '\n  ')
+    annotations_json = json.dumps(meta_info_dict["annotations"], indent=2).replace('\n', '\n  ')
+
+    proc = None
+    power_reports = None
+    restart_delay_s = 1
     while True:
-        le_datetime = datetime.utcnow()
-        seg_start_time_utc = le_datetime.isoformat() + 'Z'
-        compact_datetime_str = le_datetime.isoformat(sep='_', timespec='seconds') + 'Z'
-        # convert eg: '2024-09-15_04:28:13Z'  into: `20240915_042813Z`
-        more_compact_datetimestr = re.sub('\-|\:', '', compact_datetime_str)
+        if proc is None:
+            proc, power_reports = start_streaming_capture(cmd_argv, cmd_str)
+        seg_start_time_utc, more_compact_datetimestr = utc_timestamp_strs(time.time())
         full_filename_stem = f'{base_filename_stem}_{more_compact_datetimestr}'
-        # first we will write data to a temporary complex (I/Q) signed byte file
-        tmp_data_file_path = f'{tmp_path}{full_filename_stem}.cs8'
-        max_power, avg_power = capture_one_data_segment(cmd_str_stem, tmp_data_file_path)
+        n_captured, max_power, avg_power = capture_one_data_segment(
+            proc.stdout, power_reports, segment_bufs[0], step_powers)
+        if n_captured < segment_nbytes:
+            rc = proc.wait()
+            # stderr is closed by read_power_reports
+            proc.stdout.close()
+            if 0 != rc:
+                print(f"hackrf_transfer failed with result code: {rc}")
+            # restart the capture on the next pass, backing off while it keeps failing (eg HackRF unplugged)
+            proc = None
+            print(f"restarting in {restart_delay_s} s ...")
+            time.sleep(restart_delay_s)
+            restart_delay_s = min(restart_delay_s * 2, 60)
+            continue
+        restart_delay_s = 1
         keep_segment = False
         power_delta = max_power - avg_power  # for a legit signal, max power should well exceed average
         if (power_delta >= min_peak_gap_dbfs) or (max_power > peak_squelch_dbfs):
@@ -186,28 +336,29 @@ def main():
         print(
             f"check (peak > squelch): {max_power:0.2f} > {peak_squelch_dbfs} or (peak - avg) {power_delta:0.2f} > {min_peak_gap_dbfs} ")
         if keep_segment:
-            # move the tmp data file to a more persistent location
+            # kept segments are first written to a temporary complex (I/Q) signed byte file
+            tmp_data_file_path = f'{tmp_path}{full_filename_stem}.cs8'
             solid_data_file_path = f'{out_path}{full_filename_stem}.sigmf-data'
-            print(f"moving {tmp_data_file_path} to {solid_data_file_path} ...")
-            if tmp_path == out_path:
-                os.rename(tmp_data_file_path, solid_data_file_path)
-            else:
-                # this method takes care of deleting the tmp file
-                shutil.move(tmp_data_file_path, solid_data_file_path)
 
             # create a meta file for the data
             meta_info_dict["captures"][0][SigMFFile.DATETIME_KEY] = seg_start_time_utc
             meta_info_dict["captures"][0]["stellanovat:max_power_dbfs"] = max_power
             meta_out_path = f'{out_path}{full_filename_stem}.sigmf-meta'
-            meta_json = json.dumps(meta_info_dict, indent=2)
+            captures_json = json.dumps(meta_info_dict["captures"], indent=2).replace('\n', '\n  ')
+            meta_json = (f'{{\n  "global": {global_json},\n  "captures": {captures_json},'
+                         f'\n  "annotations": {annotations_json}\n}}')
 
-            with open(meta_out_path, "w") as meta_outfile:
-                meta_outfile.write(meta_json)
-            print(f"wrote:\n{meta_out_path}")
+            if pending_save is not None:
+                # the other buffer must be free before we start capturing into it
+                # (any failure has already been reported by report_save_failure)
+                wait([pending_save])
+            pending_save = segment_writer.submit(save_segment, segment_bufs[0], tmp_data_file_path,
+                                                 solid_data_file_path, meta_out_path, meta_json)
+            pending_save.add_done_callback(report_save_failure)
+            segment_bufs.reverse()
         else:
-            # remove the data file that did not meet squelch standard
-            print(f"deleting {tmp_data_file_path} ...")
-            os.remove(tmp_data_file_path)
+            # this segment did not meet squelch standard: its buffer is simply reused
+            print(f"discarding {full_filename_stem} ...")
 
 
 if __name__ == "__main__":
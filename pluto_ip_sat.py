@@ -5,8 +5,8 @@ using an IP-connected Pluto SDR, via SatDump,
 and output in SigMF format
 """
 from subprocess import Popen, PIPE, STDOUT
-import re
 import argparse
+import shlex
 import os
 import json
 from datetime import datetime, timezone
@@ -141,8 +141,7 @@ def main():
     # SatDump's native output file format would be something like:
     # 2024-08-09_03-55-00_10000000SPS_1176000000Hz.cs16
 
-    # date_time_str = datetime.utcnow().isoformat()+'Z'
-    date_time_str = datetime.utcnow().isoformat(sep='_',timespec='seconds')+'Z'
+    date_time_str = datetime.now(timezone.utc).strftime('%Y-%m-%d_%H:%M:%SZ')
 
     print(f"datttsr {date_time_str}")
     full_file_path = f'{out_path}{date_time_str}'
@@ -153,25 +152,22 @@ def main():
 
     # gain_mode 3 == hybrid
     record_duration = duration_seconds + 1
-    opt_str = (f"record {base_data_out_path} --source plutosdr --frequency {ctr_freq_hz} "
-                f"--samplerate {sample_rate_hz} --baseband_format cs16  --gain_mode 3 --gain 40 "
-                f"--ip_address {sdr_ip_address} --auto_reconnect true --timeout {record_duration}")
+    opt_argv = ['record', base_data_out_path, '--source', 'plutosdr', '--frequency', str(ctr_freq_hz),
+                '--samplerate', str(sample_rate_hz), '--baseband_format', 'cs16', '--gain_mode', '3', '--gain', '40',
+                '--ip_address', sdr_ip_address, '--auto_reconnect', 'true', '--timeout', str(record_duration)]
 
-    cmd_str = f"{satdump_bin_path} {opt_str}"
+    cmd_argv = [satdump_bin_path] + opt_argv
+    cmd_str = shlex.join(cmd_argv)
     print(f"START:\n{cmd_str} ")
 
-    # Regex to match and extract numeric values
-    regex = r"[-+]?\d*\.\d+|\d+"
-
     total_power = float(0)
     step_count = 0
     line_count = 0
     capture_start_utc = None
     if bandcode != 'V1':
-        with (Popen([cmd_str], stdout=PIPE, stderr=STDOUT, text=True, shell=True) as proc):
+        capture_start_utc = datetime.now(timezone.utc).strftime('%Y-%m-%d_%H:%M:%SZ')
+        with (Popen(cmd_argv, stdout=PIPE, stderr=STDOUT, text=True, bufsize=1) as proc):
             for line in proc.stdout:
-                if capture_start_utc is None:
-                    capture_start_utc = datetime.utcnow().replace(microsecond=0).isoformat('_', )+'Z'
                 line_count += 1
     else:
         # save a fake signal file
@@ -192,10 +188,10 @@ def main():
     meta_info_dict = {
         "global": {
             SigMFFile.DATATYPE_KEY: 'ci16_le',
-            SigMFFile.SAMPLE_RATE_KEY: int(f'{sample_rate_hz}'),
+            SigMFFile.SAMPLE_RATE_KEY: sample_rate_hz,
             SigMFFile.HW_KEY: "PlutoPlus SDR, dual cascaded 20 dB 5GHz LNA",
             SigMFFile.AUTHOR_KEY: 'Todd Stellanova',
-            SigMFFile.VERSION_KEY: f'{sigmf.__version__}',
+            SigMFFile.VERSION_KEY: sigmf.__version__,
             SigMFFile.DESCRIPTION_KEY: f'Band {bandcode} recorded using satdump',
             SigMFFile.RECORDER_KEY: 'satdump',
             'antenna:type': 'Wideband',
@@ -207,29 +203,26 @@ def main():
         "captures": [
             {
                 SigMFFile.START_INDEX_KEY: 0,
-                SigMFFile.FREQUENCY_KEY: int(f'{ctr_freq_hz}'),
+                SigMFFile.FREQUENCY_KEY: ctr_freq_hz,
                 SigMFFile.DATETIME_KEY: f'{capture_start_utc}',
                 'stellanovat:sdr_amp_mode': 'hybrid',
                 'stellanovat:sdr_rx_amp_enabled': 1,
-                "stellanovat:recorder_command": f'{cmd_str}',
+                "stellanovat:recorder_command": cmd_str,
             }
         ],
         "annotations": [
             {
                 SigMFFile.START_INDEX_KEY: 0,
-                SigMFFile.LENGTH_INDEX_KEY: int(f'{n_samples}'),
-                SigMFFile.FHI_KEY: int(f'{freq_upper_edge}'),
-                SigMFFile.FLO_KEY: int(f'{freq_lower_edge}'),
+                SigMFFile.LENGTH_INDEX_KEY: n_samples,
+                SigMFFile.FHI_KEY: freq_upper_edge,
+                SigMFFile.FLO_KEY: freq_lower_edge,
                 SigMFFile.LABEL_KEY: f'Band {bandcode}',
             }
         ]
     }
 
-    meta_json = json.dumps(meta_info_dict, indent=2)
-    # print(meta_json)
-
-    with open(meta_out_path, "w") as meta_outfile:
-        meta_outfile.write(meta_json)
+    with open(meta_out_path, "w", buffering=1 << 16) as meta_outfile:
+        json.dump(meta_info_dict, meta_outfile, indent=2)
 
     print(f"wrote {meta_out_path}")
 